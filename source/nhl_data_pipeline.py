@@ -2,21 +2,46 @@
 Module to scrape data from a website and save it to an Excel file.
 """
 import asyncio
+import json
 import os
+import re
 import time
 import urllib.parse
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from html import unescape
 
 import aiohttp
-from bs4 import BeautifulSoup
-from openpyxl import Workbook, load_workbook
+import lxml.html
+from pyexcelerate import Workbook
 
 # Constants
 BASE_URL = "https://www.scrapethissite.com/pages/forms/"
+BASE_URL_PARTS = urllib.parse.urlsplit(BASE_URL)
+BASE_ORIGIN = f"{BASE_URL_PARTS.scheme}://{BASE_URL_PARTS.netloc}"
 OUTPUT_ZIP = "output/scraped_pages.zip"
 EXCEL_FILE = "output/NHL_Stats.xlsx"
+PAGINATION_CACHE = "output/.pagination_cache.json"
 SHEET_1_NAME = "NHL Stats 1990-2011"
 SHEET_2_NAME = "Winner and Loser per Year"
+MAX_CONCURRENT_REQUESTS = 16
+MAX_CONNECTIONS = 32
+REQUEST_TIMEOUT = 30
+PAGINATION_RE = re.compile(r'<ul class="pagination">(.*?)</ul>', re.S)
+PAGE_LINK_RE = re.compile(r'<a(?![^>]*aria-label)[^>]*href="([^"]+)"')
+TABLE_RE = re.compile(r'<table class="table">.*?</table>', re.S)
+
+
+async def decode_body(response):
+    """
+    Read a response body and decode it as UTF-8. The site is served as UTF-8, so this skips the
+    charset detection done by response.text().
+    :param response:
+    :return:
+    :rtype:
+    """
+    data = await response.read()
+    return data.decode("utf-8", errors="replace")
 
 
 async def fetch_page(session, url):
@@ -30,12 +55,97 @@ async def fetch_page(session, url):
     :rtype:
     """
     async with session.get(url) as response:
-        return await response.text()
+        return await decode_body(response)
+
+
+def get_absolute_url(page_url):
+    """
+    Resolve a link found on BASE_URL. The site's same-origin links are resolved by string concatenation
+    against the precomputed base, and only other forms of links go through urljoin.
+    :param page_url:
+    :return:
+    :rtype:
+    """
+    if page_url.startswith(("http://", "https://")):
+        return page_url
+    if page_url.startswith("/") and not page_url.startswith("//"):
+        return f"{BASE_ORIGIN}{page_url}"
+    if page_url.startswith("?"):
+        return f"{BASE_URL}{page_url}"
+
+    return urllib.parse.urljoin(BASE_URL, page_url)
+
+
+async def fetch_numbered_page(session, semaphore, page_num, url):
+    """
+    Fetch a page once a request slot is free and return its page number together with its HTML content.
+    :param session:
+    :param semaphore:
+    :param page_num:
+    :param url:
+    """
+    async with semaphore:
+        return page_num, await fetch_page(session, url)
+
+
+def load_pagination_cache():
+    """
+    Load the cached pagination links of BASE_URL together with their ETag and Last-Modified validators.
+    :return:
+    :rtype:
+    """
+    try:
+        with open(PAGINATION_CACHE, encoding="utf-8") as f:
+            cache = json.load(f)
+        # Only a cache holding the links of BASE_URL can answer a 304
+        page_urls = cache.get("page_urls")
+        if cache.get("url") == BASE_URL and isinstance(page_urls, list) and page_urls:
+            return cache
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    return {}
+
+
+def save_pagination_cache(page_urls, etag, last_modified):
+    """
+    Persist the pagination links of BASE_URL together with their validators.
+    :param page_urls:
+    :param etag:
+    :param last_modified:
+    """
+    try:
+        with open(PAGINATION_CACHE, "w", encoding="utf-8") as f:
+            json.dump({"url": BASE_URL, "etag": etag, "last_modified": last_modified, "page_urls": page_urls}, f)
+    except OSError as exc:
+        print(f"An error occurred: {exc}")
+
+
+def parse_pages_url(html):
+    """
+    Extract the pagination links, excluding the 'Next' and 'Previous' links that carry an 'aria-label'
+    attribute. The pagination block is sliced out with a regex; the HTML is only parsed as a fallback.
+    :param html:
+    :return:
+    :rtype:
+    """
+    pagination = PAGINATION_RE.search(html)
+    page_urls = [unescape(href) for href in PAGE_LINK_RE.findall(pagination.group(1))] if pagination else []
+
+    if not page_urls:
+        root = lxml.html.fromstring(html)
+        page_urls = [str(href) for href in root.xpath(
+            '//ul[contains(concat(" ", normalize-space(@class), " "), " pagination ")]'
+            '//a[not(@aria-label)]/@href')]
+
+    return page_urls
 
 
 async def get_pages_url(session):
     """
     Find the total number of pages by extracting pagination links.
+    The links are cached on disk and revalidated with a conditional request, so the page is only
+    downloaded and parsed again when it has changed.
     :param session:
     :type session:
     :return:
@@ -43,15 +153,25 @@ async def get_pages_url(session):
     """
     page_urls = []
     try:
-        html = await fetch_page(session, BASE_URL)
-        soup = BeautifulSoup(html, "html.parser")
-
-        # Find the pagination section
-        pagination = soup.find("ul", class_="pagination")
-
-        # Get page urls by excluding the 'Next' and 'Previous' links using 'aria-label' attribute
-        if pagination:
-            page_urls = [a['href'] for a in pagination.find_all("a", attrs={"aria-label": False})]
+        cache = load_pagination_cache()
+        request_headers = {}
+        if cache.get("etag"):
+            request_headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            request_headers["If-Modified-Since"] = cache["last_modified"]
+
+        async with session.get(BASE_URL, headers=request_headers) as response:
+            # Pagination has not changed since the last run
+            if response.status == 304:
+                return cache["page_urls"]
+            html = await decode_body(response)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+        page_urls = parse_pages_url(html)
+
+        if page_urls and (etag or last_modified):
+            save_pagination_cache(page_urls, etag, last_modified)
     except Exception as exc:
         print(f"An error occurred: {exc}")
 
@@ -60,54 +180,110 @@ async def get_pages_url(session):
 
 async def extract():
     """
-    Scrape all pages and save their HTML content to a ZIP archive.
+    Scrape all pages, save their HTML content to a ZIP archive and return the table data along with
+    the team with most and least wins per year, {year: (team, num_wins)}. Returns None if any step
+    fails, so a partial scrape is never saved.
     :return:
     :rtype:
     """
+    # Pages are archived to a temporary file that only replaces OUTPUT_ZIP once the scrape succeeded
+    tmp_zip = f"{OUTPUT_ZIP}.tmp"
     try:
-        async with aiohttp.ClientSession() as session:
+        # One pooled connector for the whole run so every page reuses the same keep-alive connections
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONCURRENT_REQUESTS,
+                                         ttl_dns_cache=300, keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as session:
             page_urls = await get_pages_url(session)
+            if not page_urls:
+                print(f"No pages found on {BASE_URL}")
+                return None
             print(f"Total Pages Found: {page_urls}")
 
-            # Fetch all pages asynchronously
-            tasks = [fetch_page(session, urllib.parse.urljoin(BASE_URL, page_url)) for page_url in page_urls]
-            results = await asyncio.gather(*tasks)
-
+            loop = asyncio.get_running_loop()
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+            parsed = {}
             rows = []
             headers = []
-            # Save all HTML pages inside a ZIP archive
-            with zipfile.ZipFile(OUTPUT_ZIP, "w") as zip_file:
-                for page_num, html in enumerate(results, start=1):
-                    rows, headers = get_html_table(html, rows)
-                    save_html_to_zip(zip_file, html, page_num)
-
-            # Save scraped data into an Excel file
-            save_to_excel(rows, headers)
-            print(f"Scraped {page_num} pages and saved to {OUTPUT_ZIP}")
+            # Parse each page in a worker process as soon as it is downloaded, while the remaining
+            # pages are still in flight. The ZIP archive is only written from this coroutine, and pages
+            # are stored uncompressed so archiving costs no CPU.
+            with ProcessPoolExecutor() as pool, \
+                    zipfile.ZipFile(tmp_zip, "w", compression=zipfile.ZIP_STORED) as zip_file:
+                # Fetch all pages asynchronously, capping the number of requests in flight. Each
+                # download is scheduled as soon as its task is created.
+                async with asyncio.TaskGroup() as tg:
+                    tasks = [tg.create_task(fetch_numbered_page(session, semaphore, page_num,
+                                                                get_absolute_url(page_url)))
+                             for page_num, page_url in enumerate(page_urls, start=1)]
+
+                    for task in asyncio.as_completed(tasks):
+                        page_num, html = await task
+                        parsed[page_num] = loop.run_in_executor(pool, get_html_table, html)
+                        save_html_to_zip(zip_file, html, page_num)
+
+                # Merge the parsed pages back in page order, keeping a running winner and loser per year
+                year_winner = {}
+                year_loser = {}
+                for page_num in sorted(parsed):
+                    page_table = await parsed[page_num]
+                    if page_table is None:
+                        raise ValueError(f"No table data found on page {page_num}")
+                    page_rows, headers = page_table
+                    rows.extend(page_rows)
+                    update_winners_and_losers(page_rows, headers, year_winner, year_loser)
+
+            os.replace(tmp_zip, OUTPUT_ZIP)
+
+            print(f"Scraped {len(parsed)} pages and saved to {OUTPUT_ZIP}")
+            return rows, headers, year_winner, year_loser
     except Exception as exc:
-        print(f"An error occurred: {exc}")
+        # Report the failed downloads wrapped by the TaskGroup rather than the group itself
+        for error in exc.exceptions if isinstance(exc, ExceptionGroup) else [exc]:
+            print(f"An error occurred: {error!r}")
+        if os.path.exists(tmp_zip):
+            os.remove(tmp_zip)
+        return None
 
 
-def get_html_table(html, rows):
+def get_html_table(html):
     """
-    Fetch table data
+    Fetch table data of a single page
     :param html:
-    :param rows:
     """
     try:
-        soup = BeautifulSoup(html, "html.parser")
+        rows = []
+
+        # Find the table, building a tree for the table alone rather than the whole page. The regex stops
+        # at the first closing tag, so a slice containing a nested table is cut short and the whole page
+        # is parsed instead.
+        table_html = TABLE_RE.search(html)
+        if table_html and table_html.group(0).lower().count("<table") == 1:
+            table = lxml.html.fragment_fromstring(table_html.group(0))
+        else:
+            table = lxml.html.fromstring(html).xpath(
+                '//table[contains(concat(" ", normalize-space(@class), " "), " table ")]')[0]
 
-        # Find the table
-        table = soup.find("table", class_="table")
+        # Rows of this table only, leaving out the rows of any nested table
+        table_rows = table.xpath("./tr | ./thead/tr | ./tbody/tr | ./tfoot/tr")
 
         # Extract headers
-        headers = [th.text.strip() for th in table.find_all("th")]
+        headers = [th.text_content().strip() for tr in table_rows for th in tr.findall("th")]
+
+        # Wins are stored as numbers so they compare numerically downstream
+        wins_idx = headers.index("Wins") if "Wins" in headers else None
 
         # Extract rows after Skipping header row
-        for tr in table.find_all("tr")[1:]:
-            cells = [td.text.strip() for td in tr.find_all("td")]
+        for tr in table_rows[1:]:
+            cells = [td.text_content().strip() for td in tr.findall("td")]
             # Skip empty rows
             if cells:
+                # An empty or non-numeric Wins cell is left blank instead of dropping the page
+                if wins_idx is not None and wins_idx < len(cells):
+                    try:
+                        cells[wins_idx] = int(cells[wins_idx])
+                    except ValueError:
+                        cells[wins_idx] = None
                 rows.append(cells)
         return rows, headers
     except Exception as exc:
@@ -122,96 +298,81 @@ def save_html_to_zip(zip_file, html, page_num):
     :param page_num:
     """
     try:
-        file_name = f"{page_num}.html"
-        with open(file_name, "w", encoding="utf-8") as f:
-            f.write(html)
-        zip_file.write(file_name)
-        os.remove(file_name)
+        zip_file.writestr(f"{page_num}.html", html)
     except Exception as exc:
         print(f"An error occurred: {exc}")
 
 
-def save_to_excel(rows, headers):
+def update_winners_and_losers(rows, headers, year_winner, year_loser):
     """
-    Save scraped data into an Excel file.
+    Update the running team with most and least wins per year, {year: (team, num_wins)}, with the rows
+    of one page. On a tie the team seen first keeps the place.
     :param rows:
     :param headers:
+    :param year_winner:
+    :param year_loser:
     """
+    year_idx = headers.index("Year")
+    team_idx = headers.index("Team Name")
+    wins_idx = headers.index("Wins")
+    for row in rows:
+        year, team, wins = row[year_idx], row[team_idx], row[wins_idx]
+        # Skip teams without a win count
+        if wins is None:
+            continue
+
+        # Team with most wins
+        if year not in year_winner or wins > year_winner[year][1]:
+            year_winner[year] = (team, wins)
+        # Team with the least wins
+        if year not in year_loser or wins < year_loser[year][1]:
+            year_loser[year] = (team, wins)
+
+
+def transform(year_winner, year_loser):
+    """
+    Build the summary rows with the winner and loser of each year.
+    :param year_winner:
+    :param year_loser:
+    :return:
+    :rtype:
+    """
+    sheet_2_rows = [["Year", "Winner", "Winner Num. of Wins", "Loser", "Loser Num. of Wins"]]
     try:
-        # Create an Excel workbook and sheet
-        wb = Workbook()
-        ws = wb.active
-        ws.title = SHEET_1_NAME
-
-        # Write headers
-        ws.append(headers)
-
-        # Write data rows
-        for row in rows:
-            ws.append(row)
-
-        # Save Excel file
-        wb.save(EXCEL_FILE)
-        print(f"Excel file '{EXCEL_FILE}' created successfully with sheet '{SHEET_1_NAME}'")
+        for year, (winner, winner_wins) in year_winner.items():
+            loser, loser_wins = year_loser[year]
+            sheet_2_rows.append([year, winner, winner_wins, loser, loser_wins])
     except Exception as exc:
         print(f"An error occurred: {exc}")
 
+    return sheet_2_rows
+
 
-def transform():
+def save_to_excel(rows, headers, summary_rows):
     """
-    Transform scraped data into an Excel file.
+    Save scraped data and the yearly summary into an Excel file.
+    :param rows:
+    :param headers:
+    :param summary_rows:
     """
     try:
-        wb = load_workbook(EXCEL_FILE)
-        ws = wb[SHEET_1_NAME]
-
-        # Read data into a dictionary {year: {team: num_wins}}
-        stats = {}
-
-        # Identify column indexes
-        header = [cell.value for cell in ws[1]]
-        year_idx = header.index("Year")
-        team_idx = header.index("Team Name")
-        wins_idx = header.index("Wins")
-
-        # Process rows
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            year, team, wins = row[year_idx], row[team_idx], row[wins_idx]
-
-            if year not in stats:
-                stats[year] = {}
-
-            # {'1990': {'Boston Bruins': '44', 'Buffalo Sabres': '31'}}
-            stats[year][team] = wins
-
-        # Compute winners and losers
-        sheet_2_headers = [["Year", "Winner", "Winner Num. of Wins", "Loser", "Loser Num. of Wins"]]
-
-        for year, teams in stats.items():
-            # Team with most wins
-            winner = max(teams, key=teams.get)
-            # Team with the least wins
-            loser = min(teams, key=teams.get)
-            sheet_2_headers.append([year, winner, teams[winner], loser, teams[loser]])
-
-        # Create a new sheet and write data
-        if SHEET_2_NAME in wb.sheetnames:
-            wb.remove(wb[SHEET_2_NAME])
-
-        ws_summary = wb.create_sheet(SHEET_2_NAME)
-
-        for row in sheet_2_headers:
-            ws_summary.append(row)
+        # Create an Excel workbook with both sheets, each written in one bulk call
+        wb = Workbook()
+        wb.new_sheet(SHEET_1_NAME, data=[headers, *rows])
+        wb.new_sheet(SHEET_2_NAME, data=summary_rows)
 
-        # Save the workbook
+        # Save Excel file
         wb.save(EXCEL_FILE)
-        print(f"Sheet '{SHEET_2_NAME}' created successfully.")
+        print(f"Excel file '{EXCEL_FILE}' created successfully with sheets '{SHEET_1_NAME}' and '{SHEET_2_NAME}'")
     except Exception as exc:
         print(f"An error occurred: {exc}")
 
 
 if __name__ == "__main__":
     start_time = time.time()
-    asyncio.run(extract())
-    transform()
+    extracted = asyncio.run(extract())
+    # Keep the previous Excel file if the scrape failed or found nothing
+    if extracted and extracted[0]:
+        scraped_rows, table_headers, winners, losers = extracted
+        save_to_excel(scraped_rows, table_headers, transform(winners, losers))
     print(f"Execution time: {time.time() - start_time} seconds.")
@@ -1,13 +1,39 @@
 """
 Unit tests for the ETL task.
 """
+import asyncio
+import json
+import os
+import tempfile
 import unittest
+import zipfile
 from unittest.mock import AsyncMock, patch, MagicMock
 
 import aiohttp
 
-from source.nhl_data_pipeline import fetch_page, get_pages_url, get_html_table, save_to_excel, \
-    transform
+from source.nhl_data_pipeline import extract, fetch_page, get_absolute_url, get_pages_url, get_html_table, \
+    load_pagination_cache, parse_pages_url, save_html_to_zip, save_to_excel, transform, update_winners_and_losers
+
+
+def mock_page_response(rows, delay=0):
+    """
+    Build a mocked response context manager for a page with the given (team, year, wins) rows,
+    whose body is read after the given delay.
+    :param rows:
+    :param delay:
+    """
+    cells = "".join(f"<tr><td>{team}</td><td>{year}</td><td>{wins}</td></tr>" for team, year, wins in rows)
+    html = f'<html><table class="table"><tr><th>Team Name</th><th>Year</th><th>Wins</th></tr>{cells}</table></html>'
+
+    async def read():
+        await asyncio.sleep(delay)
+        return html.encode("utf-8")
+
+    mock_response = MagicMock()
+    mock_response.read = read
+    mock_context = MagicMock()
+    mock_context.__aenter__.return_value = mock_response
+    return mock_context
 
 
 class TestScraper(unittest.IsolatedAsyncioTestCase):
@@ -20,7 +46,7 @@ class TestScraper(unittest.IsolatedAsyncioTestCase):
         Test fetch_page without making actual HTTP requests.
         """
         mock_response = AsyncMock()
-        mock_response.text.return_value = "<html><body>Test Page</body></html>"
+        mock_response.read.return_value = b"<html><body>Test Page</body></html>"
         mock_get.return_value.__aenter__.return_value = mock_response
 
         async with aiohttp.ClientSession() as session:
@@ -28,8 +54,10 @@ class TestScraper(unittest.IsolatedAsyncioTestCase):
 
         self.assertEqual(result, "<html><body>Test Page</body></html>")
 
-    @patch("source.nhl_data_pipeline.fetch_page")
-    async def test_get_pages_url(self, mock_fetch_page):
+    @patch("source.nhl_data_pipeline.save_pagination_cache")
+    @patch("source.nhl_data_pipeline.load_pagination_cache", return_value={})
+    @patch("aiohttp.ClientSession.get")
+    async def test_get_pages_url(self, mock_get, mock_load_cache, mock_save_cache):
         """
         Test get_pages_url with mocked HTML.
         """
@@ -42,13 +70,82 @@ class TestScraper(unittest.IsolatedAsyncioTestCase):
             </ul>
         </html>
         '''
-        mock_fetch_page.return_value = mock_html
+        mock_response = MagicMock(status=200, headers={"ETag": '"abc"'})
+        mock_response.read = AsyncMock(return_value=mock_html.encode("utf-8"))
+        mock_get.return_value.__aenter__.return_value = mock_response
 
         async with aiohttp.ClientSession() as session:
             result = await get_pages_url(session)
 
         expected_pages = ["/pages/forms/?page=1", "/pages/forms/?page=2", "/pages/forms/?page=3"]
         self.assertEqual(result, expected_pages)
+        mock_save_cache.assert_called_once_with(expected_pages, '"abc"', None)
+
+    @patch("source.nhl_data_pipeline.load_pagination_cache")
+    @patch("aiohttp.ClientSession.get")
+    async def test_get_pages_url_not_modified(self, mock_get, mock_load_cache):
+        """
+        Test get_pages_url reuses the cached links when the page has not changed.
+        """
+        cached_pages = ["/pages/forms/?page=1", "/pages/forms/?page=2"]
+        mock_load_cache.return_value = {"etag": '"abc"', "last_modified": None, "page_urls": cached_pages}
+        mock_response = MagicMock(status=304)
+        mock_get.return_value.__aenter__.return_value = mock_response
+
+        async with aiohttp.ClientSession() as session:
+            result = await get_pages_url(session)
+
+        self.assertEqual(result, cached_pages)
+        mock_get.assert_called_once_with("https://www.scrapethissite.com/pages/forms/",
+                                         headers={"If-None-Match": '"abc"'})
+        mock_response.read.assert_not_called()
+
+    def test_load_pagination_cache(self):
+        """
+        Test a cache file is only used when it holds the page links of the base URL.
+        """
+        base_url = "https://www.scrapethissite.com/pages/forms/"
+        valid_cache = {"url": base_url, "etag": '"abc"', "last_modified": None, "page_urls": ["/pages/forms/?page=1"]}
+        caches = [(valid_cache, valid_cache),
+                  ({"url": base_url, "etag": '"abc"'}, {}),
+                  ({"url": base_url, "etag": '"abc"', "page_urls": []}, {}),
+                  ({**valid_cache, "url": "https://example.com/"}, {}),
+                  (["not", "a", "dict"], {})]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, "pagination_cache.json")
+            with patch("source.nhl_data_pipeline.PAGINATION_CACHE", cache_file):
+                for cache, expected in caches:
+                    with open(cache_file, "w", encoding="utf-8") as f:
+                        json.dump(cache, f)
+                    self.assertEqual(load_pagination_cache(), expected)
+
+    def test_get_absolute_url(self):
+        """
+        Test resolving pagination links against the base URL.
+        """
+        self.assertEqual(get_absolute_url("/pages/forms/?page_num=2"),
+                         "https://www.scrapethissite.com/pages/forms/?page_num=2")
+        self.assertEqual(get_absolute_url("?page_num=2"), "https://www.scrapethissite.com/pages/forms/?page_num=2")
+        self.assertEqual(get_absolute_url("https://example.com/?page_num=2"), "https://example.com/?page_num=2")
+        self.assertEqual(get_absolute_url("../?page_num=2"), "https://www.scrapethissite.com/pages/?page_num=2")
+
+    def test_parse_pages_url_fallback(self):
+        """
+        Test parse_pages_url falls back to HTML parsing when the regex does not match.
+        """
+        mock_html = '''
+        <html>
+            <ul class="pagination pagination-sm">
+                <li><a href="/pages/forms/?page=1&amp;per_page=25">1</a></li>
+                <li><a href="/pages/forms/?page=2&amp;per_page=25">2</a></li>
+                <li><a href="/pages/forms/?page=2&amp;per_page=25" aria-label="Next">&raquo;</a></li>
+            </ul>
+        </html>
+        '''
+        result = parse_pages_url(mock_html)
+
+        self.assertEqual(result, ["/pages/forms/?page=1&per_page=25", "/pages/forms/?page=2&per_page=25"])
 
     def test_get_html_table(self):
         """
@@ -63,51 +160,212 @@ class TestScraper(unittest.IsolatedAsyncioTestCase):
             </table>
         </html>
         '''
-        rows, headers = get_html_table(mock_html, [])
+        rows, headers = get_html_table(mock_html)
 
         expected_headers = ["Team", "Wins"]
-        expected_rows = [["Boston Bruins", "44"], ["Chicago Blackhawks", "30"]]
+        expected_rows = [["Boston Bruins", 44], ["Chicago Blackhawks", 30]]
 
         self.assertEqual(headers, expected_headers)
         self.assertEqual(rows, expected_rows)
 
+    def test_save_html_to_zip(self):
+        """
+        Test writing an HTML page into the ZIP archive.
+        """
+        mock_zip_file = MagicMock()
+
+        save_html_to_zip(mock_zip_file, "<html><body>Test Page</body></html>", 1)
+
+        mock_zip_file.writestr.assert_called_once_with("1.html", "<html><body>Test Page</body></html>")
+
+    def test_get_html_table_class_token(self):
+        """
+        Test extracting table data from a table with several classes.
+        """
+        mock_html = '''
+        <html>
+            <table class="table table-striped">
+                <tr><th>Team</th><th>Wins</th></tr>
+                <tr><td>Boston Bruins</td><td>44</td></tr>
+            </table>
+        </html>
+        '''
+        rows, headers = get_html_table(mock_html)
+
+        self.assertEqual(headers, ["Team", "Wins"])
+        self.assertEqual(rows, [["Boston Bruins", 44]])
+
+    def test_get_html_table_nested_table(self):
+        """
+        Test extracting table data when a cell contains a nested table.
+        """
+        mock_html = '''
+        <html>
+            <table class="table">
+                <tr><th>Team</th><th>Wins</th></tr>
+                <tr><td>A<table><tr><td>x</td></tr></table></td><td>44</td></tr>
+                <tr><td>B</td><td>30</td></tr>
+            </table>
+        </html>
+        '''
+        rows, headers = get_html_table(mock_html)
+
+        self.assertEqual(headers, ["Team", "Wins"])
+        self.assertEqual(rows, [["Ax", 44], ["B", 30]])
+
+    def test_get_html_table_invalid_wins(self):
+        """
+        Test an empty or non-numeric Wins cell is left blank without dropping the page.
+        """
+        mock_html = '''
+        <html>
+            <table class="table">
+                <tr><th>Team</th><th>Wins</th></tr>
+                <tr><td>Boston Bruins</td><td>44</td></tr>
+                <tr><td>Chicago Blackhawks</td><td></td></tr>
+                <tr><td>Quebec Nordiques</td><td>n/a</td></tr>
+                <tr><td>San Jose Sharks</td><td>²</td></tr>
+            </table>
+        </html>
+        '''
+        rows, headers = get_html_table(mock_html)
+
+        self.assertEqual(headers, ["Team", "Wins"])
+        self.assertEqual(rows, [["Boston Bruins", 44], ["Chicago Blackhawks", None], ["Quebec Nordiques", None],
+                                ["San Jose Sharks", None]])
+
     @patch("source.nhl_data_pipeline.Workbook")
     def test_save_to_excel(self, mock_workbook):
         """
         Test saving data to Excel.
         """
-        mock_ws = MagicMock()
         mock_wb = MagicMock()
-        mock_wb.active = mock_ws
         mock_workbook.return_value = mock_wb
 
         rows = [["Boston Bruins", "44"], ["Chicago Blackhawks", "30"]]
         headers = ["Team", "Wins"]
-        save_to_excel(rows, headers)
+        summary_rows = [["Year", "Winner", "Winner Num. of Wins", "Loser", "Loser Num. of Wins"],
+                        [1990, "Boston Bruins", 44, "Chicago Blackhawks", 30]]
+        save_to_excel(rows, headers, summary_rows)
 
-        mock_ws.append.assert_any_call(headers)
-        mock_ws.append.assert_any_call(["Boston Bruins", "44"])
-        mock_ws.append.assert_any_call(["Chicago Blackhawks", "30"])
-        mock_wb.save.assert_called_once()
+        mock_wb.new_sheet.assert_any_call("NHL Stats 1990-2011",
+                                          data=[headers, ["Boston Bruins", "44"], ["Chicago Blackhawks", "30"]])
+        mock_wb.new_sheet.assert_any_call("Winner and Loser per Year", data=summary_rows)
+        mock_wb.save.assert_called_once_with("output/NHL_Stats.xlsx")
 
-    @patch("source.nhl_data_pipeline.load_workbook")
-    def test_transform(self, mock_load_workbook):
+    def test_update_winners_and_losers(self):
         """
-        Test transforming data in Excel.
+        Test keeping the running winner and loser of each year across pages, keeping the first team on a tie.
         """
-        mock_ws = MagicMock()
-        mock_ws.iter_rows.return_value = [(1990, "Boston Bruins", 44), (1990, "Chicago Blackhawks", 30)]
-        # Mocking the header row
-        mock_ws.__getitem__.return_value = [MagicMock(value="Year"), MagicMock(value="Team Name"),
-                                            MagicMock(value="Wins")]
-        mock_wb = MagicMock()
-        mock_wb.__getitem__.return_value = mock_ws
-        mock_load_workbook.return_value = mock_wb
+        headers = ["Team Name", "Year", "Wins"]
+        # 1990 spans both pages
+        page_1_rows = [["Boston Bruins", "1990", 44], ["Buffalo Sabres", "1990", 31], ["Calgary Flames", "1990", 46]]
+        page_2_rows = [["Chicago Blackhawks", "1990", 49], ["Quebec Nordiques", "1990", 16],
+                       ["Detroit Red Wings", "1991", 43], ["Montreal Canadiens", "1991", 41],
+                       ["New York Rangers", "1991", 43], ["Hartford Whalers", "1991", 26],
+                       ["San Jose Sharks", "1991", 17], ["Edmonton Oilers", "1991", 17], ["Unknown", "1991", None]]
+        year_winner = {}
+        year_loser = {}
+
+        update_winners_and_losers(page_1_rows, headers, year_winner, year_loser)
+        update_winners_and_losers(page_2_rows, headers, year_winner, year_loser)
+
+        self.assertEqual(year_winner, {"1990": ("Chicago Blackhawks", 49), "1991": ("Detroit Red Wings", 43)})
+        self.assertEqual(year_loser, {"1990": ("Quebec Nordiques", 16), "1991": ("San Jose Sharks", 17)})
+
+    def test_transform(self):
+        """
+        Test computing the winner and loser of each year.
+        """
+        year_winner = {"1990": ("Chicago Blackhawks", 49), "1991": ("Detroit Red Wings", 43)}
+        year_loser = {"1990": ("Quebec Nordiques", 16), "1991": ("San Jose Sharks", 17)}
+
+        result = transform(year_winner, year_loser)
+
+        expected_rows = [["Year", "Winner", "Winner Num. of Wins", "Loser", "Loser Num. of Wins"],
+                         ["1990", "Chicago Blackhawks", 49, "Quebec Nordiques", 16],
+                         ["1991", "Detroit Red Wings", 43, "San Jose Sharks", 17]]
+        self.assertEqual(result, expected_rows)
+
+    @patch("builtins.print")
+    @patch("source.nhl_data_pipeline.get_pages_url")
+    @patch("aiohttp.ClientSession.get")
+    async def test_extract_failed_download(self, mock_get, mock_get_pages_url, mock_print):
+        """
+        Test extract reports the error of a failed download and returns no data.
+        """
+        def get_page(url, **kwargs):
+            if url.endswith("page=2"):
+                raise aiohttp.ClientOSError("connection reset on page 2")
+            return mock_page_response([("Boston Bruins", "1990", 44)])
+
+        mock_get.side_effect = get_page
+        mock_get_pages_url.return_value = ["/pages/forms/?page=1", "/pages/forms/?page=2"]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_zip = os.path.join(tmp_dir, "scraped_pages.zip")
+            with zipfile.ZipFile(output_zip, "w") as zip_file:
+                zip_file.writestr("previous.html", "<html></html>")
+
+            with patch("source.nhl_data_pipeline.OUTPUT_ZIP", output_zip):
+                result = await extract()
+
+            # The previous archive is kept and the temporary one is removed
+            with zipfile.ZipFile(output_zip) as zip_file:
+                self.assertEqual(zip_file.namelist(), ["previous.html"])
+            self.assertEqual(os.listdir(tmp_dir), ["scraped_pages.zip"])
+
+        self.assertIsNone(result)
+        printed = " ".join(str(call.args[0]) for call in mock_print.call_args_list)
+        self.assertIn("connection reset on page 2", printed)
+
+    @patch("builtins.print")
+    @patch("source.nhl_data_pipeline.get_pages_url", return_value=[])
+    async def test_extract_no_pages(self, mock_get_pages_url, mock_print):
+        """
+        Test extract returns no data and leaves the archive alone when no pages are found.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch("source.nhl_data_pipeline.OUTPUT_ZIP", os.path.join(tmp_dir, "scraped_pages.zip")):
+                result = await extract()
+
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+        self.assertIsNone(result)
+        mock_print.assert_called_once_with("No pages found on https://www.scrapethissite.com/pages/forms/")
+
+    @patch("source.nhl_data_pipeline.get_pages_url")
+    @patch("aiohttp.ClientSession.get")
+    async def test_extract(self, mock_get, mock_get_pages_url):
+        """
+        Test extract merges pages that finish downloading out of order back in page order.
+        """
+        pages = {
+            "/pages/forms/?page=1": mock_page_response([("Boston Bruins", "1990", 44),
+                                                        ("Quebec Nordiques", "1990", 16)], delay=0.06),
+            "/pages/forms/?page=2": mock_page_response([("Chicago Blackhawks", "1990", 49),
+                                                        ("Detroit Red Wings", "1991", 43)], delay=0.03),
+            "/pages/forms/?page=3": mock_page_response([("New York Rangers", "1991", 43),
+                                                        ("San Jose Sharks", "1991", 17)]),
+        }
+        mock_get.side_effect = lambda url, **kwargs: pages[url.removeprefix("https://www.scrapethissite.com")]
+        mock_get_pages_url.return_value = list(pages)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_zip = os.path.join(tmp_dir, "scraped_pages.zip")
+            with patch("source.nhl_data_pipeline.OUTPUT_ZIP", output_zip):
+                rows, headers, year_winner, year_loser = await extract()
 
-        transform()
+            with zipfile.ZipFile(output_zip) as zip_file:
+                self.assertEqual(sorted(zip_file.namelist()), ["1.html", "2.html", "3.html"])
+            self.assertEqual(os.listdir(tmp_dir), ["scraped_pages.zip"])
 
-        mock_wb.create_sheet.assert_called_with("Winner and Loser per Year")
-        mock_wb.save.assert_called_once()
+        self.assertEqual(headers, ["Team Name", "Year", "Wins"])
+        self.assertEqual(rows, [["Boston Bruins", "1990", 44], ["Quebec Nordiques", "1990", 16],
+                                ["Chicago Blackhawks", "1990", 49], ["Detroit Red Wings", "1991", 43],
+                                ["New York Rangers", "1991", 43], ["San Jose Sharks", "1991", 17]])
+        self.assertEqual(year_winner, {"1990": ("Chicago Blackhawks", 49), "1991": ("Detroit Red Wings", 43)})
+        self.assertEqual(year_loser, {"1990": ("Quebec Nordiques", 16), "1991": ("San Jose Sharks", 17)})
 
 
 if __name__ == "__main__":